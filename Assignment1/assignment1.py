@@ -24,65 +24,171 @@ __version__ = 1.1
 
 # IMPORTS
 import argparse as ap
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing as mp
-import csv
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import mmap
+import os
 import sys
 
-
-def chunks(number, mysize):
-    """ Returns the chunks. """
-    mychunks = []
-    for i in range(mysize):
-        start = int(i * len(number) / mysize)
-        end = int((i + 1) * len(number) / mysize)
-        mychunks.append(number[start:end])
-
-    return mychunks
+import numpy as np
+
+try:
+    from numba import config, get_num_threads, njit, prange, set_num_threads, types
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+# GLOBALS
+BLOCK_SIZE = 4 << 20  # Bytes of a FastQ file scanned at a time
+BATCH_SIZE = 16384  # Reads per pool task
+
+
+def batches(number, size):
+    """ Yields the (start, end) row bounds of consecutive batches of at most size rows. """
+    for start in range(0, len(number), size):
+        yield start, min(start + size, len(number))
+
+
+def quality_lines(block, last):
+    """ Copies the quality lines of the complete records in a block of a file.
+        Return the concatenated lines, their lengths and the bytes consumed.
+    """
+    newlines = np.flatnonzero(block == ord("\n"))
+    if last and block[-1] != ord("\n"):
+        newlines = np.append(newlines, block.size)
+    records = newlines.size // 4
+    if records == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64), block.size if last else 0
+    starts = newlines[2:4 * records:4] + 1
+    ends = newlines[3:4 * records:4]
+    ends = ends - (block[ends - 1] == ord("\r"))
+    lengths = ends - starts
+    starts, ends, lengths = starts[lengths > 0], ends[lengths > 0], lengths[lengths > 0]
+
+    # Mark the bytes of every quality line and copy them out in one pass
+    inside = np.zeros(block.size + 1, dtype=np.int8)
+    inside[starts] = 1
+    inside[ends] = -1
+    flat = block[np.cumsum(inside[:-1], dtype=np.int8).view(bool)]
+    return flat, lengths, block.size if last else newlines[4 * records - 1] + 1
 
 
 def read_fastq(fastq_file):
-    """ Reads the files"""
-    quality = []
-    qual = True
-
-    with open(fastq_file, encoding='UTF-8') as fastq:
-        while qual:
-            header = fastq.readline()
-            nucleotides = fastq.readline()
-            strand = fastq.readline()
-            qual = fastq.readline().rstrip()
-            if qual:
-                quality.append(qual)
-            if header or nucleotides or strand:
-                pass
-
+    """ Reads the quality lines of a file into a matrix with one read per row """
+    flats, lengths = [], []
+    with open(fastq_file, 'rb') as fastq:
+        size = os.fstat(fastq.fileno()).st_size
+        if size == 0:
+            return np.zeros((0, 0), dtype=np.uint8)
+        with mmap.mmap(fastq.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Scan the file a block at a time so the temporaries stay block sized;
+            # the unfinished record at the end of a block starts the next one
+            pos, window = 0, BLOCK_SIZE
+            while pos < size:
+                last = pos + window >= size
+                block = np.frombuffer(mapped, dtype=np.uint8, count=min(window, size - pos), offset=pos)
+                flat, block_lengths, consumed = quality_lines(block, last)
+                del block
+                if consumed == 0:
+                    # A single record does not fit in the block
+                    window *= 2
+                    continue
+                flats.append(flat)
+                lengths.append(block_lengths)
+                pos += consumed
+
+    flat, lengths = np.concatenate(flats), np.concatenate(lengths)
+    if lengths.size == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    if (lengths == lengths[0]).all():
+        return flat.reshape(-1, lengths[0])
+    # Ragged reads: right-pad with 0, which is never a valid quality character
+    quality = np.zeros((lengths.size, lengths.max()), dtype=np.uint8)
+    quality[np.arange(quality.shape[1]) < lengths[:, None]] = flat
     return quality
 
 
+def _phred_sum_numpy(phreds):
+    """ Sums the PHRED scores and counts the reads per column of a quality matrix """
+    if phreds.size and phreds[:, -1].all():
+        # Reads are only padded at the end, so no read is padded and every column holds them all
+        counts = np.full(phreds.shape[1], phreds.shape[0], dtype=np.int64)
+    else:
+        counts = (phreds != 0).sum(axis=0, dtype=np.int64)
+    return phreds.sum(axis=0, dtype=np.int64) - 33 * counts, counts
+
+
+if _NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _phred_sum_numba(phreds, nblocks):
+        """ Sums the PHRED scores and counts the reads per column, one block of rows per thread """
+        nrows, ncols = phreds.shape
+        sums = np.zeros((nblocks, ncols), dtype=np.int64)
+        counts = np.zeros((nblocks, ncols), dtype=np.int64)
+        for block in prange(nblocks):
+            for i in range(block * nrows // nblocks, (block + 1) * nrows // nblocks):
+                for j in range(ncols):
+                    # Branch free, the PHRED offset is taken off once per column below
+                    char = phreds[i, j]
+                    sums[block, j] += char
+                    counts[block, j] += char != 0
+        counts = counts.sum(axis=0)
+        return sums.sum(axis=0) - 33 * counts, counts
+
+    def phred_sum(phreds):
+        """ Sums the PHRED scores and counts the reads per column of a quality matrix """
+        return _phred_sum_numba(phreds, get_num_threads())
+
+    # Compile at import instead of inside every worker. The workers are forked after
+    # this, which the TBB and GNU OpenMP thread pools do not survive.
+    config.THREADING_LAYER = "workqueue"
+    for _readonly in (True, False):
+        _phred_sum_numba.compile((types.Array(types.uint8, 2, "C", readonly=_readonly), types.intp))
+else:
+    phred_sum = _phred_sum_numpy
+
+
+def single_threaded():
+    """ Limits the PHRED kernel to one thread in a process that runs next to other workers """
+    if _NUMBA_AVAILABLE:
+        set_num_threads(1)
+
+
 def calculate_quals(quality):
     """ Calculates quality scores """
-    results = []
-    for qual in quality:
-        for item, checker in enumerate(qual):
-            try:
-                results[item] += ord(checker) - 33
-            except IndexError:
-                results.append(ord(checker) - 33)
-    return results
+    sums, _ = phred_sum(quality)
+    return sums.tolist()
+
+
+def share_quality(quality):
+    """ Copies the quality matrix into a new shared memory block """
+    shm = SharedMemory(create=True, size=max(quality.nbytes, 1))
+    np.ndarray(quality.shape, dtype=quality.dtype, buffer=shm.buf)[:] = quality
+    return shm
+
+
+def calculate_shared_quals(task):
+    """ Calculates quality scores for a row range of a shared quality matrix """
+    shm_name, shape, start, end = task
+    shm = SharedMemory(name=shm_name)
+    quality = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    phredscores = calculate_quals(quality[start:end])
+    del quality
+    shm.close()
+    return phredscores
 
 
 def generate_output(average_phredscores, csvfile):
     """ Generates the output for the file('s) """
+    lines = "".join(f"{i},{score}\n" for i, score in enumerate(average_phredscores))
     if csvfile is None:
-        csv_writer = csv.writer(sys.stdout, delimiter=',')
-        for i, score in enumerate(average_phredscores):
-            csv_writer.writerow([i, score])
+        sys.stdout.write(lines)
 
     else:
-        with open(csvfile, 'w', encoding='UTF-8', newline='') as myfastq:
-            csv_writer = csv.writer(myfastq, delimiter=',')
-            for i, score in enumerate(average_phredscores):
-                csv_writer.writerow([i, score])
+        with open(csvfile, 'w', encoding='UTF-8') as myfastq:
+            myfastq.write(lines)
 
 
 if __name__ == '__main__':
@@ -97,23 +203,37 @@ if __name__ == '__main__':
                            nargs='+', help="At least 1 ILLUMINA fastq file to process")
     args = argparser.parse_args()
 
-    for file in args.fastq_files:
-        print(file)
-        qualities = read_fastq(file)
-        qual_chunked = chunks(qualities, 4)
-
-        with mp.Pool(args.n) as pool:
-            phredscores = pool.map(calculate_quals, qual_chunked)
-
-        phredscores_avg = [sum(i) / len(qualities) for i in zip(*phredscores)]
-
-        if len(args.fastq_files) > 1:
-            if args.CSVfile is None:
-                sys.stdout.write(file + "\n")
-                CSV = None
+    # One pool for all files, the workers attach to each file's matrix by name
+    # Start the resource tracker before forking so the workers share it when attaching
+    resource_tracker.ensure_running()
+    with mp.Pool(args.n, initializer=single_threaded) as pool, ThreadPoolExecutor(max_workers=1) as reader:
+        # Read the next file in the background while the pool works on the current one
+        upcoming = reader.submit(read_fastq, args.fastq_files[0])
+        for index, file in enumerate(args.fastq_files):
+            print(file)
+            qualities = upcoming.result()
+            if index + 1 < len(args.fastq_files):
+                upcoming = reader.submit(read_fastq, args.fastq_files[index + 1])
+            shm = share_quality(qualities)
+            try:
+                tasks = ((shm.name, qualities.shape, start, end) for start, end in batches(qualities, BATCH_SIZE))
+                phredscores = np.zeros(qualities.shape[1], dtype=np.int64)
+                # Add up the batches as they finish while the pool works on the rest
+                for partial in pool.imap_unordered(calculate_shared_quals, tasks, chunksize=1):
+                    phredscores += partial
+            finally:
+                shm.close()
+                shm.unlink()
+
+            phredscores_avg = phredscores / len(qualities)
+
+            if len(args.fastq_files) > 1:
+                if args.CSVfile is None:
+                    sys.stdout.write(file + "\n")
+                    CSV = None
+                else:
+                    CSV = f'{file}.{args.CSVfile}'
             else:
-                CSV = f'{file}.{args.CSVfile}'
-        else:
-            CSV = args.CSVfile
+                CSV = args.CSVfile
 
-        generate_output(phredscores_avg, CSV)
+            generate_output(phredscores_avg, CSV)
@@ -33,168 +33,249 @@ __version__ = 1.0
 # IMPORTS
 import argparse as ap
 import multiprocessing as mp
-from multiprocessing.managers import BaseManager, SyncManager
-import csv
+from multiprocessing.shared_memory import SharedMemory
 import sys
-import time
-import queue
 import os
+import pickle
+import mmap
+
+import numpy as np
+import zmq
+
+try:
+    from numba import config, get_num_threads, njit, prange, set_num_threads, types
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
 
 # GLOBALS
 POISONPILL = "STOP"
+READY = "READY"
 ERROR = "OHNO"
-IP = ''
+IP = '127.0.0.1'
 PORTNUM = 4896  # Changed the port number
-AUTHKEY = b'secretpassword'
+BLOCK_SIZE = 4 << 20  # Bytes of a FastQ file scanned at a time
+IDLE_TIMEOUT = 30000  # Milliseconds a worker waits for a reply from the server
 
 
-def make_server_manager(port, authkey):
-    """ Create a manager for the server, listening on the given port.
-        Return a manager object with get_job_q and get_result_q methods.
+def make_server_socket(port):
+    """ Create the socket for the server, listening on the given port. Workers
+        ask it for work and get a job or the stop signal back.
+        Return the zmq context and the socket.
     """
-    job_q = queue.Queue()
-    result_q = queue.Queue()
-
-    # This is based on the examples in the official docs of multiprocessing.
-    # get_{job|result}_q return synchronized proxies for the actual Queue
-    # objects.
-    class QueueManager(BaseManager):
-        pass
-
-    QueueManager.register('get_job_q', callable=lambda: job_q)
-    QueueManager.register('get_result_q', callable=lambda: result_q)
-
-    manager = QueueManager(address=('127.0.0.1', port), authkey=authkey)
-    manager.start()
+    # Only bind on localhost, the socket unpickles whatever it receives
+    context = zmq.Context()
+    job_socket = context.socket(zmq.ROUTER)
+    job_socket.bind(f"tcp://127.0.0.1:{port}")
     print('Server started at port %s' % port)
-    return manager
+    return context, job_socket
 
 
 def chunks(number, mysize):
-    """ Returns the chunks. """
+    """ Returns the (start, end) row bounds of the chunks. """
     mychunks = []
     for i in range(mysize):
         start = int(i * len(number) / mysize)
         end = int((i + 1) * len(number) / mysize)
-        mychunks.append(number[start:end])
+        mychunks.append((start, end))
 
     return mychunks
 
 
-def read_fastq(fastq_file):
-    """ Reads the files"""
-    quality = []
-    qual = True
-
-    with open(fastq_file, encoding='UTF-8') as fastq:
-        while qual:
-            header = fastq.readline()
-            nucleotides = fastq.readline()
-            strand = fastq.readline()
-            qual = fastq.readline().rstrip()
-            if qual:
-                quality.append(qual)
-            if header or nucleotides or strand:
-                pass
+def quality_lines(block, last):
+    """ Copies the quality lines of the complete records in a block of a file.
+        Return the concatenated lines, their lengths and the bytes consumed.
+    """
+    newlines = np.flatnonzero(block == ord("\n"))
+    if last and block[-1] != ord("\n"):
+        newlines = np.append(newlines, block.size)
+    records = newlines.size // 4
+    if records == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64), block.size if last else 0
+    starts = newlines[2:4 * records:4] + 1
+    ends = newlines[3:4 * records:4]
+    ends = ends - (block[ends - 1] == ord("\r"))
+    lengths = ends - starts
+    starts, ends, lengths = starts[lengths > 0], ends[lengths > 0], lengths[lengths > 0]
+
+    # Mark the bytes of every quality line and copy them out in one pass
+    inside = np.zeros(block.size + 1, dtype=np.int8)
+    inside[starts] = 1
+    inside[ends] = -1
+    flat = block[np.cumsum(inside[:-1], dtype=np.int8).view(bool)]
+    return flat, lengths, block.size if last else newlines[4 * records - 1] + 1
+
 
+def read_fastq(fastq_file):
+    """ Reads the quality lines of a file into a matrix with one read per row """
+    flats, lengths = [], []
+    with open(fastq_file, 'rb') as fastq:
+        size = os.fstat(fastq.fileno()).st_size
+        if size == 0:
+            return np.zeros((0, 0), dtype=np.uint8)
+        with mmap.mmap(fastq.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Scan the file a block at a time so the temporaries stay block sized;
+            # the unfinished record at the end of a block starts the next one
+            pos, window = 0, BLOCK_SIZE
+            while pos < size:
+                last = pos + window >= size
+                block = np.frombuffer(mapped, dtype=np.uint8, count=min(window, size - pos), offset=pos)
+                flat, block_lengths, consumed = quality_lines(block, last)
+                del block
+                if consumed == 0:
+                    # A single record does not fit in the block
+                    window *= 2
+                    continue
+                flats.append(flat)
+                lengths.append(block_lengths)
+                pos += consumed
+
+    flat, lengths = np.concatenate(flats), np.concatenate(lengths)
+    if lengths.size == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    if (lengths == lengths[0]).all():
+        return flat.reshape(-1, lengths[0])
+    # Ragged reads: right-pad with 0, which is never a valid quality character
+    quality = np.zeros((lengths.size, lengths.max()), dtype=np.uint8)
+    quality[np.arange(quality.shape[1]) < lengths[:, None]] = flat
     return quality
 
 
+def _phred_sum_numpy(phreds):
+    """ Sums the PHRED scores and counts the reads per column of a quality matrix """
+    if phreds.size and phreds[:, -1].all():
+        # Reads are only padded at the end, so no read is padded and every column holds them all
+        counts = np.full(phreds.shape[1], phreds.shape[0], dtype=np.int64)
+    else:
+        counts = (phreds != 0).sum(axis=0, dtype=np.int64)
+    return phreds.sum(axis=0, dtype=np.int64) - 33 * counts, counts
+
+
+if _NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _phred_sum_numba(phreds, nblocks):
+        """ Sums the PHRED scores and counts the reads per column, one block of rows per thread """
+        nrows, ncols = phreds.shape
+        sums = np.zeros((nblocks, ncols), dtype=np.int64)
+        counts = np.zeros((nblocks, ncols), dtype=np.int64)
+        for block in prange(nblocks):
+            for i in range(block * nrows // nblocks, (block + 1) * nrows // nblocks):
+                for j in range(ncols):
+                    # Branch free, the PHRED offset is taken off once per column below
+                    char = phreds[i, j]
+                    sums[block, j] += char
+                    counts[block, j] += char != 0
+        counts = counts.sum(axis=0)
+        return sums.sum(axis=0) - 33 * counts, counts
+
+    def phred_sum(phreds):
+        """ Sums the PHRED scores and counts the reads per column of a quality matrix """
+        return _phred_sum_numba(phreds, get_num_threads())
+
+    # Compile at import instead of inside every worker. The workers are forked after
+    # this, which the TBB and GNU OpenMP thread pools do not survive.
+    config.THREADING_LAYER = "workqueue"
+    for _readonly in (True, False):
+        _phred_sum_numba.compile((types.Array(types.uint8, 2, "C", readonly=_readonly), types.intp))
+else:
+    phred_sum = _phred_sum_numpy
+
+
+def single_threaded():
+    """ Limits the PHRED kernel to one thread in a process that runs next to other workers """
+    if _NUMBA_AVAILABLE:
+        set_num_threads(1)
+
+
 def calculate_quals(quality):
     """ Calculates quality scores """
-    results = []
-    for qual in quality:
-        for item, checker in enumerate(qual):
-            try:
-                results[item] += ord(checker) - 33
-            except IndexError:
-                results.append(ord(checker) - 33)
-    return results
+    sums, _ = phred_sum(quality)
+    return sums.tolist()
+
+
+def share_quality(quality):
+    """ Copies the quality matrix into a new shared memory block """
+    shm = SharedMemory(create=True, size=max(quality.nbytes, 1))
+    np.ndarray(quality.shape, dtype=quality.dtype, buffer=shm.buf)[:] = quality
+    return shm
+
+
+def calculate_shared_quals(task):
+    """ Calculates quality scores for a row range of a shared quality matrix """
+    shm_name, shape, start, end = task
+    shm = SharedMemory(name=shm_name)
+    quality = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    phredscores = calculate_quals(quality[start:end])
+    del quality
+    shm.close()
+    return phredscores
 
 
 def generate_output(average_phredscores, csvfile):
     """ Generates the output for the file('s) """
+    lines = "".join(f"{i},{score}\n" for i, score in enumerate(average_phredscores))
     if csvfile is None:
-        csv_writer = csv.writer(sys.stdout, delimiter=',')
-        for i, score in enumerate(average_phredscores):
-            csv_writer.writerow([i, score])
+        sys.stdout.write(lines)
 
     else:
-        with open(csvfile, 'w', encoding='UTF-8', newline='') as myfastq:
-            csv_writer = csv.writer(myfastq, delimiter=',')
-            for i, score in enumerate(average_phredscores):
-                csv_writer.writerow([i, score])
-
-
-def runserver(fn, data, deler, csvout):
-    # Start a shared manager server and access its queues
-    manager = make_server_manager(PORTNUM, AUTHKEY)
-    shared_job_q = manager.get_job_q()
-    shared_result_q = manager.get_result_q()
+        with open(csvfile, 'w', encoding='UTF-8') as myfastq:
+            myfastq.write(lines)
 
-    if not data:
-        return
-
-    print("Sending data!")
-    for d in data:
-        shared_job_q.put({'fn': fn, 'arg': d})
 
-    time.sleep(2)
+def runserver(fn, data, deler, csvout, num_workers):
+    # Bind the socket the workers connect to
+    context, job_socket = make_server_socket(PORTNUM)
 
+    jobs = iter(data)
     results = []
-    while True:
-        try:
-            result = shared_result_q.get_nowait()
-            results.append(result)
-            if len(results) == len(data):
-                print("Got all results!\n")
-                break
-        except queue.Empty:
-            time.sleep(1)
-            continue
-    # Tell the client process no more data will be forthcoming
-    shared_job_q.put(POISONPILL)
-    # Sleep a bit before shutting down the server - to give clients time to
-    # realize the job queue is empty and exit in an orderly way.
-    time.sleep(5)
-    manager.shutdown()
-    phreds = []
-    for result in results:
-        phreds.append(result['result'])
-    phredscores_avg = [sum(i) / deler for i in zip(*phreds)]
+    stopped = 0
+    print("Sending data!")
+    # Every worker asks for work, first with READY and then by returning its
+    # result, so a job only goes to an idle worker. Once the jobs run out each
+    # worker is told to stop, after which all results are in.
+    while stopped < num_workers:
+        worker, empty, message = job_socket.recv_multipart()
+        message = pickle.loads(message)
+        if message != READY:
+            results.append(message)
+        job = next(jobs, None)
+        if job is None:
+            reply = POISONPILL
+            stopped += 1
+        else:
+            reply = {'fn': fn, 'arg': job}
+        job_socket.send_multipart([worker, empty, pickle.dumps(reply)])
+    print("Got all results!\n")
+    # Closing blocks until the stop signals are flushed to the workers, for at most a second
+    context.destroy(linger=1000)
+    if not results:
+        return
+    phreds = np.vstack([np.asarray(result['result'], dtype=np.int64) for result in results])
+    phredscores_avg = phreds.sum(axis=0) / deler
     generate_output(phredscores_avg, csvout)
 
 
-def make_client_manager(ip, port, authkey):
-    """ Create a manager for a client. This manager connects to a server on the
-        given address and exposes the get_job_q and get_result_q methods for
-        accessing the shared queues from the server.
-        Return a manager object.
+def make_client_socket(ip, port):
+    """ Create the socket for a worker, connected to a server on the given
+        address. Each request to the server is answered with a job or the
+        stop signal.
+        Return the zmq context and the socket.
     """
-    class ServerQueueManager(BaseManager):
-        pass
-
-    ServerQueueManager.register('get_job_q')
-    ServerQueueManager.register('get_result_q')
-
-    manager = ServerQueueManager(address=(ip, port), authkey=authkey)
-    manager.connect()
-
-    print('Client connected to %s:%s' % (ip, port))
-    return manager
+    context = zmq.Context()
+    job_socket = context.socket(zmq.REQ)
+    job_socket.connect(f"tcp://{ip}:{port}")
+    return context, job_socket
 
 
 def runclient(num_processes):
-    manager = make_client_manager(IP, PORTNUM, AUTHKEY)
-    job_q = manager.get_job_q()
-    result_q = manager.get_result_q()
-    run_workers(job_q, result_q, num_processes)
+    print('Client connecting to %s:%s' % (IP, PORTNUM))
+    run_workers(IP, PORTNUM, num_processes)
 
 
-def run_workers(job_q, result_q, num_processes):
+def run_workers(ip, port, num_processes):
     processes = []
     for p in range(num_processes):
-        temP = mp.Process(target=peon, args=(job_q, result_q))
+        temP = mp.Process(target=peon, args=(ip, port))
         processes.append(temP)
         temP.start()
     print("Started %s workers!" % len(processes))
@@ -202,25 +283,23 @@ def run_workers(job_q, result_q, num_processes):
         temP.join()
 
 
-def peon(job_q, result_q):
-    my_name = mp.current_process().name
-    while True:
+def peon(ip, port):
+    # The workers already run in parallel, the kernel should not add threads on top
+    single_threaded()
+    # Each worker needs its own context, they do not survive a fork
+    context, job_socket = make_client_socket(ip, port)
+    job_socket.send_pyobj(READY)
+    # Block until the server replies, give up if it went away
+    while job_socket.poll(IDLE_TIMEOUT):
+        job = job_socket.recv_pyobj()
+        if job == POISONPILL:
+            break
         try:
-            job = job_q.get_nowait()
-            if job == POISONPILL:
-                job_q.put(POISONPILL)
-                # print("Aaaaaaargh", my_name)
-                return
-            else:
-                try:
-                    result = job['fn'](job['arg'])
-                    result_q.put({'job': job, 'result': result})
-                except NameError:
-                    result_q.put({'job': job, 'result': ERROR})
-
-        except queue.Empty:
-            print("sleep", my_name)
-            time.sleep(1)
+            result = job['fn'](job['arg'])
+            job_socket.send_pyobj({'job': job, 'result': result})
+        except NameError:
+            job_socket.send_pyobj({'job': job, 'result': ERROR})
+    context.destroy(linger=0)
 
 
 if __name__ == '__main__':
@@ -256,12 +335,19 @@ if __name__ == '__main__':
             out_file = file.split('/')[-1]
             CSV = f'{out_file}.{args.CSVfile}'
         qualities = read_fastq(file)
-        qual_chunked = chunks(qualities, args.chunks)
-
-        server = mp.Process(target=runserver, args=(calculate_quals, qual_chunked, len(qualities), CSV))
-        server.start()
-        time.sleep(1)
-        client = mp.Process(target=runclient, args=(4,))
-        client.start()
-        server.join()
-        client.join()
+        # The jobs only name a row range of the shared matrix instead of carrying the rows
+        shm = share_quality(qualities)
+        try:
+            qual_chunked = [(shm.name, qualities.shape, start, end) for start, end in chunks(qualities, args.chunks)]
+
+            num_workers = 4
+            server = mp.Process(target=runserver,
+                                args=(calculate_shared_quals, qual_chunked, len(qualities), CSV, num_workers))
+            server.start()
+            client = mp.Process(target=runclient, args=(num_workers,))
+            client.start()
+            server.join()
+            client.join()
+        finally:
+            shm.close()
+            shm.unlink()
@@ -23,8 +23,21 @@ __version__ = 1.0
 
 # IMPORTS
 import argparse
+import mmap
+import os
+import sys
 from pathlib import Path
 from mpi4py import MPI
+import numpy as np
+
+try:
+    from numba import get_num_threads, njit, prange, set_num_threads
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+# GLOBALS
+BLOCK_SIZE = 4 << 20  # Bytes of a FastQ file scanned at a time
 
 def parse_args():
     """Parses the CLI arguments given to the script."""
@@ -46,92 +59,172 @@ def parse_args():
     )
     return parser.parse_args()
 
+def record_start(mapped, pos):
+    """Returns the offset of the first FastQ record that starts at or after pos."""
+    size = len(mapped)
+    if pos > 0:
+        newline = mapped.find(b"\n", pos - 1)
+        pos = size if newline == -1 else newline + 1
+    while pos < size:
+        # Quality lines can start with @ as well, only a header has the + line two lines on
+        if mapped[pos:pos + 1] == b"@":
+            sequence = mapped.find(b"\n", pos) + 1
+            separator = mapped.find(b"\n", sequence) + 1 if sequence else 0
+            if separator and mapped[separator:separator + 1] == b"+":
+                return pos
+        newline = mapped.find(b"\n", pos)
+        pos = size if newline == -1 else newline + 1
+    return size
+
+def quality_lines(block, last):
+    """Copies the quality lines of the complete records in a block of a file.
+    Returns the concatenated lines, their lengths and the bytes consumed."""
+    newlines = np.flatnonzero(block == ord("\n"))
+    if last and block[-1] != ord("\n"):
+        newlines = np.append(newlines, block.size)
+    records = newlines.size // 4
+    if records == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64), block.size if last else 0
+    starts = newlines[2:4 * records:4] + 1
+    ends = newlines[3:4 * records:4]
+    ends = ends - (block[ends - 1] == ord("\r"))
+    lengths = ends - starts
+    starts, ends, lengths = starts[lengths > 0], ends[lengths > 0], lengths[lengths > 0]
+
+    # Mark the bytes of every quality line and copy them out in one pass
+    inside = np.zeros(block.size + 1, dtype=np.int8)
+    inside[starts] = 1
+    inside[ends] = -1
+    flat = block[np.cumsum(inside[:-1], dtype=np.int8).view(bool)]
+    return flat, lengths, block.size if last else newlines[4 * records - 1] + 1
+
 def read_fastq_chunk(file_path, start, stop):
-    """Reads a chunk of a FastQ file and returns the quality scores."""
-    quality_scores = []
-    with open(file_path, 'r', encoding='UTF-8') as file:
-        file.seek(start)
-        while file.tell() < stop:
-            quality = file.readline().strip()
-            if quality:
-                quality_scores.append(quality)
-    return quality_scores
-
-def calculate_phred_scores(quality_scores):
+    """Reads the quality lines of the records starting between start and stop
+    into a matrix with one read per row."""
+    flats, lengths = [], []
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return np.zeros((0, 0), dtype=np.uint8)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Every rank moves both of its bounds to the next record, so each record
+            # is read by exactly one rank
+            pos, end = record_start(mapped, start), record_start(mapped, stop)
+            window = BLOCK_SIZE
+            while pos < end:
+                last = pos + window >= end
+                block = np.frombuffer(mapped, dtype=np.uint8, count=min(window, end - pos), offset=pos)
+                flat, block_lengths, consumed = quality_lines(block, last)
+                del block
+                if consumed == 0:
+                    # A single record does not fit in the block
+                    window *= 2
+                    continue
+                flats.append(flat)
+                lengths.append(block_lengths)
+                pos += consumed
+
+    if not flats:
+        return np.zeros((0, 0), dtype=np.uint8)
+    flat, lengths = np.concatenate(flats), np.concatenate(lengths)
+    if lengths.size == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    if (lengths == lengths[0]).all():
+        return flat.reshape(-1, lengths[0])
+    # Ragged reads: right-pad with 0, which is never a valid quality character
+    quality = np.zeros((lengths.size, lengths.max()), dtype=np.uint8)
+    quality[np.arange(quality.shape[1]) < lengths[:, None]] = flat
+    return quality
+
+def _phred_sum_numpy(phreds):
+    """Sums the PHRED scores and counts the reads per column of a quality matrix."""
+    if phreds.size and phreds[:, -1].all():
+        # Reads are only padded at the end, so no read is padded and every column holds them all
+        counts = np.full(phreds.shape[1], phreds.shape[0], dtype=np.int64)
+    else:
+        counts = (phreds != 0).sum(axis=0, dtype=np.int64)
+    return phreds.sum(axis=0, dtype=np.int64) - 33 * counts, counts
+
+if _NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _phred_sum_numba(phreds, nblocks):
+        """Sums the PHRED scores and counts the reads per column, one block of rows per thread."""
+        nrows, ncols = phreds.shape
+        sums = np.zeros((nblocks, ncols), dtype=np.int64)
+        counts = np.zeros((nblocks, ncols), dtype=np.int64)
+        for block in prange(nblocks):
+            for i in range(block * nrows // nblocks, (block + 1) * nrows // nblocks):
+                for j in range(ncols):
+                    # Branch free, the PHRED offset is taken off once per column below
+                    char = phreds[i, j]
+                    sums[block, j] += char
+                    counts[block, j] += char != 0
+        counts = counts.sum(axis=0)
+        return sums.sum(axis=0) - 33 * counts, counts
+
+    def phred_sum(phreds):
+        """Sums the PHRED scores and counts the reads per column of a quality matrix."""
+        return _phred_sum_numba(phreds, get_num_threads())
+else:
+    phred_sum = _phred_sum_numpy
+
+def calculate_phred_scores(quality):
     """Calculates the sum and count of PHRED scores for a chunk."""
-    phred_sums = []
-    counts = []
-    for line in quality_scores:
-        for index, char in enumerate(line):
-            score = ord(char) - 33
-            if len(phred_sums) <= index:
-                phred_sums.append(score)
-                counts.append(1)
-            else:
-                phred_sums[index] += score
-                counts[index] += 1
-    return phred_sums, counts
+    return phred_sum(quality)
 
 def process_results(results, output_file, fastq_files):
     """Processes and outputs the final results."""
-    combined_sums = {}
-    combined_counts = {}
-
-    for file, (sums, counts) in results.items():
-        if file not in combined_sums:
-            combined_sums[file] = sums
-            combined_counts[file] = counts
-        else:
-            for i, sum_value in enumerate(sums):
-                combined_sums[file][i] += sum_value
-                combined_counts[file][i] += counts[i]
-
     for fastq_file in fastq_files:
-        averages = [combined_sums[fastq_file][i] / combined_counts[fastq_file][i] for i in range(len(combined_sums[fastq_file]))]
+        # The sums and counts are already totalled over the ranks by the MPI reduce
+        sums, counts = results[fastq_file]
+        averages = sums / counts
+        lines = "".join(f"{i},{score}\n" for i, score in enumerate(averages))
         if output_file:
             output_path = output_file.parent / f"{fastq_file.name}.{output_file.name}"
             with open(output_path, "w", encoding="UTF-8") as file:
-                for i, score in enumerate(averages):
-                    file.write(f"{i},{score}\n")
+                file.write(lines)
         else:
-            print(f"{file.name}:")
-            for i, score in enumerate(averages):
-                print(f"{i},{score}")
+            sys.stdout.write(f"{fastq_file.name}:\n{lines}")
 
 def main():
     args = parse_args()
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     nproc = comm.Get_size()
+    if _NUMBA_AVAILABLE:
+        # The affinity mask of a rank usually holds every core of the node,
+        # share it with the other ranks on the same node
+        local_ranks = comm.Split_type(MPI.COMM_TYPE_SHARED).Get_size()
+        set_num_threads(max(1, min(len(os.sched_getaffinity(0)) // local_ranks, get_num_threads())))
 
     if rank == 0:
-        chunks = []
+        # One chunk of every file per rank
+        chunks = [[] for _ in range(nproc)]
         for file_path in args.fastq_files:
             file_size = file_path.stat().st_size
             chunk_size = file_size // nproc
             for i in range(nproc):
                 start = i * chunk_size
                 stop = start + chunk_size if i < nproc - 1 else file_size
-                chunks.append((file_path, start, stop))
+                chunks[i].append((file_path, start, stop))
     else:
         chunks = None
 
-    chunk = comm.scatter(chunks, root=0)
-    quality_scores = read_fastq_chunk(*chunk)
-    phred_sums, counts = calculate_phred_scores(quality_scores)
-    result = (chunk[0], (phred_sums, counts))
-
-    all_results = comm.gather(result, root=0)
+    results = {}
+    for file_path, start, stop in comm.scatter(chunks, root=0):
+        quality = read_fastq_chunk(file_path, start, stop)
+        phred_sums, counts = calculate_phred_scores(quality)
+
+        # Pad to the file's longest read so every rank reduces equally sized buffers
+        length = comm.allreduce(len(phred_sums), op=MPI.MAX)
+        local = np.zeros((2, length), dtype=np.int64)
+        local[0, :len(phred_sums)] = phred_sums
+        local[1, :len(counts)] = counts
+        total = np.empty_like(local) if rank == 0 else None
+        comm.Reduce(local, total, op=MPI.SUM, root=0)
+        if rank == 0:
+            results[file_path] = (total[0], total[1])
 
     if rank == 0:
-        results = {}
-        for res in all_results:
-            if res[0] not in results:
-                results[res[0]] = res[1]
-            else:
-                for i in range(len(res[1][0])):
-                    results[res[0]][0][i] += res[1][0][i]
-                    results[res[0]][1][i] += res[1][1][i]
         process_results(results, args.output_file, args.fastq_files)
 
 if __name__ == "__main__":
@@ -13,13 +13,25 @@ __author__ = "Marcel Setz"
 __version__ = 1.0
 
 # IMPORTS
-from pyspark.sql import Row, SparkSession
-from pyspark.sql.functions import col, explode, split
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import (
+    broadcast, col, count, explode, floor, max as spark_max, min as spark_min, posexplode,
+    regexp_extract, sequence, split, when
+)
 
 # GLOBALS
 CODING_KEYS = ["CDS"]
 NON_CODING_KEYS = ["ncRNA", "rRNA", "gene"]
 ALL_DESIRED_KEYS = [*CODING_KEYS, *NON_CODING_KEYS]
+# Java regular expressions for parsing the records inside Spark
+IDENTIFIER_PATTERN = r"(?m)^LOCUS +(\S+)"
+ORGANISM_PATTERN = r"(?m)^SOURCE +(.*?)\s*$"
+FEATURES_PATTERN = r"(?s)\nFEATURES[^\n]*\n(.*?)(?:\n(?! {5})|\z)"
+FEATURE_SEPARATOR = r"(?:\n {6,}[^\n]*)*\n"
+FEATURE_PATTERN = r"^ {5}(\S+) +(\S+)"
+LOCATION_PATTERN = r"^(complement\()?(\d+)\.\.(\d+)\)?$"
+BIN_SIZE = 10000  # Bases per bin when matching genes to the CDS inside them
 
 def initialize_spark_session():
     """
@@ -33,96 +45,23 @@ def initialize_spark_session():
         .master("local[4]") \
         .config("spark.executor.memory", "8g") \
         .config("spark.driver.memory", "8g") \
+        .config("spark.sql.shuffle.partitions", "8") \
+        .config("spark.default.parallelism", "8") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.parquet.compression.codec", "zstd") \
+        .config("spark.hadoop.io.file.buffer.size", str(4 << 20)) \
         .config("spark.jars.packages", "com.databricks:spark-xml_2.12:0.15.0") \
         .getOrCreate()
     return spark
 
-def extract_feature_data(record):
-    """
-    Extracts feature information from a single record in a GBFF file.
-    
-    Args:
-        record: A single record from the GBFF file.
-        
-    Returns:
-        Row: A Row object containing the identifier, organism, and features.
-    """
-    record_str = record.value
-    row = {}
-    features = []
-    at_features = False
-    for line in record_str.split("\n"):
-        if at_features:
-            if not line.startswith("     "):
-                break
-            if line[5] != " ":
-                features.append(line.strip().split())
-            continue
-
-        if line.startswith("LOCUS"):
-            row["identifier"] = line.split()[1]
-        elif line.startswith("SOURCE"):
-            row["organism"] = line.strip().split(maxsplit=1)[1]
-        elif line.startswith("FEATURES"):
-            at_features = True
-
-    row["features"] = "//".join(
-        [f"{i}, {f[0]}, {f[1]}" for i, f in enumerate(features, start=1)]
-    )
-    return Row(**row)
-
-def decompose_feature_info(row):
-    """
-    Decomposes the feature-specific info from a feature row into separate columns.
-    
-    Args:
-        row: A Row object containing features data.
-        
-    Returns:
-        Row: A Row object with separated feature information.
-    """
-    str_feat = row.features
-    info = str_feat.split(", ")
-    new_row = Row(
-        identifier=row.identifier,
-        organism=row.organism,
-        feature_index=int(info[0]),
-        key=info[1],
-        location=info[2]
-    )
-    return new_row
-
-def parse_feature_location(row):
-    """
-    Parses the location string of a feature into separate columns.
-    
-    Args:
-        row: A Row object containing the feature location.
-        
-    Returns:
-        Row: A Row object with separated location information.
-    """
-    location = row.location
-    complement = False
-    if location.startswith("complement"):
-        complement = True
-        location = location[11:-1]
-    start, stop = location.split("..")
-    new_row = Row(
-        identifier=row.identifier,
-        organism=row.organism,
-        feature_index=row.feature_index,
-        key=row.key,
-        start=int(start),
-        stop=int(stop),
-        complement=complement,
-    )
-    return new_row
-
 def create_feature_dataframe(spark, file):
     """
     Creates a DataFrame with features extracted from a .gbff file.
     
+    The records are parsed with Spark SQL expressions, so the rows stay
+    in the JVM instead of passing through Python one at a time.
+    
     Args:
         spark: SparkSession object.
         file: Path to the .gbff file.
@@ -130,18 +69,36 @@ def create_feature_dataframe(spark, file):
     Returns:
         DataFrame: DataFrame containing the extracted features.
     """
-    df_features = spark.read.text(file, lineSep="//\n")
-    extracted_rdd = df_features.rdd.map(extract_feature_data)
-    extracted_df = extracted_rdd.toDF()
-    exploded_df = extracted_df.withColumn("features", explode(split("features", "//")))
-    split_features_rdd = exploded_df.rdd.map(decompose_feature_info)
-    split_features_df = split_features_rdd.toDF()
+    df_records = spark.read.text(file, lineSep="//\n")
+    # Split the FEATURES block on the qualifier lines between the feature lines,
+    # which are indented further, so every exploded feature is a single short line
+    exploded_df = df_records.select(
+        regexp_extract("value", IDENTIFIER_PATTERN, 1).alias("identifier"),
+        regexp_extract("value", ORGANISM_PATTERN, 1).alias("organism"),
+        posexplode(
+            split(regexp_extract("value", FEATURES_PATTERN, 1), FEATURE_SEPARATOR)
+        ).alias("position", "feature"),
+    )
+    split_features_df = exploded_df.select(
+        "identifier",
+        "organism",
+        (col("position") + 1).alias("feature_index"),
+        regexp_extract("feature", FEATURE_PATTERN, 1).alias("key"),
+        regexp_extract("feature", FEATURE_PATTERN, 2).alias("location"),
+    )
     filtered_df = split_features_df.filter(
         col("key").isin(ALL_DESIRED_KEYS) &
-        col("location").rlike(r"^(?:complement\()?\d+\.{2}\d+\)?$")
+        col("location").rlike(LOCATION_PATTERN)
     )
-    final_rdd = filtered_df.rdd.map(parse_feature_location)
-    final_df = final_rdd.toDF()
+    final_df = filtered_df.select(
+        "identifier",
+        "organism",
+        "feature_index",
+        "key",
+        regexp_extract("location", LOCATION_PATTERN, 2).cast("int").alias("start"),
+        regexp_extract("location", LOCATION_PATTERN, 3).cast("int").alias("stop"),
+        col("location").startswith("complement").alias("complement"),
+    ).withColumn("length", col("stop") - col("start"))
     return final_df
 
 def exclude_coding_genes(features_df):
@@ -154,17 +111,38 @@ def exclude_coding_genes(features_df):
     Returns:
         DataFrame excluding certain gene features.
     """
-    all_genes = features_df.filter(col("key").like("gene")).alias("gene")
-    all_cds = features_df.filter(col("key").like("CDS")).alias("cds")
+    all_genes = features_df.filter(col("key") == "gene")
+    all_cds = features_df.filter(col("key") == "CDS")
+
+    # Bin the positions so the join can match on equality instead of comparing
+    # every gene with every CDS of a genome. A gene is repeated for each bin it
+    # spans, a CDS it contains starts in one of those bins.
+    gene_bins = all_genes.withColumn(
+        "bin", explode(sequence(floor(col("start") / BIN_SIZE), floor(col("stop") / BIN_SIZE)))
+    ).alias("gene")
+    cds_bins = all_cds.withColumn("bin", floor(col("start") / BIN_SIZE)).alias("cds")
 
     join_condition = [
         col("gene.identifier") == col("cds.identifier"),
+        col("gene.complement") == col("cds.complement"),
+        col("gene.bin") == col("cds.bin"),
         col("gene.start") <= col("cds.start"),
         col("gene.stop") >= col("cds.stop"),
-        col("gene.complement") == col("cds.complement"),
     ]
-    only_non_coding_genes = all_genes.join(all_cds, on=join_condition, how="left_anti")
-    return features_df.filter(~col("key").like("gene")).union(only_non_coding_genes)
+    # The CDS side is small enough to send to every task, which saves
+    # shuffling the larger gene side
+    coding_genes = gene_bins.join(broadcast(cds_bins), on=join_condition, how="left_semi") \
+        .select("identifier", "feature_index", "start", "stop").alias("coding")
+
+    # Only genes can match, the other features pass through the same anti-join
+    feature = features_df.alias("feature")
+    exclude_condition = [
+        col("feature.identifier") == col("coding.identifier"),
+        col("feature.feature_index") == col("coding.feature_index"),
+        col("feature.start") == col("coding.start"),
+        col("feature.stop") == col("coding.stop"),
+    ]
+    return feature.join(coding_genes, on=exclude_condition, how="left_anti")
 
 def question_one(df_features):
     """Calculate the average number of features per Archaea genome."""
@@ -173,8 +151,10 @@ def question_one(df_features):
 
 def question_two(df_features):
     """Calculate the ratio of coding to non-coding features."""
-    coding_count = df_features.filter(df_features["key"].isin(CODING_KEYS)).count()
-    noncoding_count = df_features.filter(df_features["key"].isin(NON_CODING_KEYS)).count()
+    coding_count, noncoding_count = df_features.agg(
+        count(when(df_features["key"].isin(CODING_KEYS), True)),
+        count(when(df_features["key"].isin(NON_CODING_KEYS), True)),
+    ).first()
     return coding_count / noncoding_count if noncoding_count != 0 else float('inf')
 
 
@@ -184,24 +164,23 @@ def question_three(df_features):
         df_features
         .filter(df_features.key.isin(CODING_KEYS))
         .groupBy("organism")
-        .agg({"key": "count"})
-        .select("count(key)")
-        .sort("count(key)")
-        .collect()
+        .agg(count("key").alias("proteins"))
+        .agg(spark_min("proteins"), spark_max("proteins"))
+        .first()
     )
-    return protein_counts[0][0], protein_counts[-1][0]
+    return protein_counts[0], protein_counts[1]
 
 
 def question_four(df_features, output_path):
     """Remove all non-coding features and save the resulting DataFrame as a Parquet file."""
-    coding_df = df_features.filter(df_features["key"] == "CDS")
-    coding_df.write.parquet(output_path)
+    # The length is only kept for question five, save the features as parsed
+    coding_df = df_features.filter(df_features["key"] == "CDS").drop("length")
+    coding_df.write.mode("overwrite").parquet(output_path)
 
 
 def question_five(df_features):
     """Calculate the average length of a feature."""
-    df_with_length = df_features.withColumn("length", col("stop") - col("start"))
-    return df_with_length.agg({"length": "mean"}).first()[0]
+    return df_features.agg({"length": "mean"}).first()[0]
 
 
 def main():
@@ -214,8 +193,14 @@ def main():
     file_path = "/data/datasets/NCBI/refseq/ftp.ncbi.nlm.nih.gov/refseq/release/archaea/archaea.1.genomic.gbff"
     output = "output/features.parquet"
 
-    df_features = create_feature_dataframe(spark, str(file_path))
-    df_features = exclude_coding_genes(df_features)
+    # Excluding the coding genes and every question scan the features,
+    # cache them so the file is only parsed once
+    df_parsed = create_feature_dataframe(spark, str(file_path))
+    df_parsed = df_parsed.persist(StorageLevel.MEMORY_AND_DISK)
+    df_features = exclude_coding_genes(df_parsed)
+    df_features = df_features.persist(StorageLevel.MEMORY_AND_DISK)
+    df_features.count()
+    df_parsed.unpersist()
 
     avg_features = question_one(df_features)
     print(f"Average number of features per Archaea genome: {avg_features:.2f}")
@@ -232,5 +217,7 @@ def main():
     avg_length = question_five(df_features)
     print(f"Average length of a feature: {avg_length:.2f}")
 
+    df_features.unpersist()
+
 if __name__ == "__main__":
     main()